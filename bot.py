@@ -1,97 +1,422 @@
+import asyncio
 import logging
 import os
-from pymongo import MongoClient
+import random
+import secrets
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from functools import partial
+import orjson
+import uvicorn
+import uvloop
+from cachetools import TTLCache
+from fastapi import FastAPI, Request, Response
+from pymongo import AsyncMongoClient
 from telegram import Update
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 # Enable logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=os.getenv('LOG_LEVEL', 'INFO').upper()
 )
+# httpx logs every Bot API request at INFO, which is noise on busy bots
+logging.getLogger('httpx').setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 # Load environment variables
-ADMIN_IDS = list(map(int, os.getenv('ADMIN_IDS', '').split(',')))
+ADMIN_IDS = frozenset(int(admin_id) for admin_id in map(str.strip, os.getenv('ADMIN_IDS', '').split(',')) if admin_id)
 DUMP_CHANNEL = os.getenv('DUMP_CHANNEL')
-FORCE_CHANNELS = list(map(str, os.getenv('FORCE_CHANNELS', '').split(',')))
+FORCE_CHANNELS = tuple(channel for channel in map(str.strip, os.getenv('FORCE_CHANNELS', '').split(',')) if channel)
+STATS_CACHE_SECONDS = int(os.getenv('STATS_CACHE_SECONDS', '30'))  # 0 disables the cache
+RAILWAY_STATIC_URL = os.getenv('RAILWAY_STATIC_URL')  # Webhook host; polling is used when unset
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+PORT = int(os.getenv('PORT', '8000'))
+# Webhook worker processes. Each one has its own Mongo pool and caches, so DB_POOL
+# applies per worker; one is enough for this bot
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '1'))
+WEBHOOK_ATTEMPTS = 10
+MAX_UPDATE_BYTES = 1024 * 1024  # Telegram updates are a few KB; anything bigger isn't from Telegram
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', '128'))  # Updates handled at the same time
+BROADCAST_CONCURRENCY = 30  # Broadcast sends in flight at once
+BROADCAST_RATE = 25  # Broadcast sends per second, under Telegram's ~30 msg/s per bot
+BROADCAST_RETRIES = 3  # Attempts per user after a 429 before giving up
+BROADCAST_CHUNK = 500  # Users read from the cursor before waiting for their sends
+NOT_MEMBER_STATUSES = frozenset({'left', 'kicked'})
+NOT_MEMBER_ERRORS = ('user not found', 'participant_id_invalid')  # get_chat_member errors meaning "not a member"
 
 # MongoDB connection
 mongo_uri = os.getenv('MONGO_URI')  # Your MongoDB URI
-client = MongoClient(mongo_uri)
+# maxPoolSize bounds database operations awaited at the same time, not handlers:
+# writes go through one background writer, so a small pool covers peak load
+client = AsyncMongoClient(
+    mongo_uri,
+    maxPoolSize=int(os.getenv('DB_POOL', '20')),
+    minPoolSize=2,
+    maxIdleTimeMS=60_000,
+    compressors='zstd,zlib',  # Compress wire traffic; zlib is the fallback
+    retryWrites=True,
+    serverSelectionTimeoutMS=5000,
+    socketTimeoutMS=20_000
+)
 db = client['telegram_bot_db']  # Your database name
 users_collection = db['users']  # Collection for user data
 files_collection = db['files']  # Collection for files data
 
-def start(update: Update, context: CallbackContext) -> None:
+# Stats cache, keyed on the current STATS_CACHE_SECONDS time bucket
+_stats_cache = {}
+
+# Channels each user was recently seen in, keyed on (user_id, channel)
+_membership_cache = TTLCache(maxsize=100_000, ttl=60)
+
+# Names of recently registered users, so repeated /start calls skip the write
+_seen_users = TTLCache(maxsize=100_000, ttl=3600)
+
+# Database writes the user doesn't have to wait for, drained by db_writer
+_write_queue = asyncio.Queue(maxsize=1000)
+
+async def db_writer():
+    while True:
+        write = await _write_queue.get()
+        try:
+            await write()
+        except Exception:
+            logger.exception("Background database write failed")
+        finally:
+            _write_queue.task_done()
+
+async def queue_write(write):
+    try:
+        _write_queue.put_nowait(write)
+    except asyncio.QueueFull:
+        # Write inline rather than drop it when the writer falls behind
+        await write()
+
+def retry_after_seconds(error):
+    # PTB is moving RetryAfter.retry_after from seconds to a timedelta
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return retry_after
+
+async def post_init(application: Application) -> None:
+    # Make sure user and file lookups are served by indexes
+    await users_collection.create_index('user_id', unique=True)
+    await files_collection.create_index('file_id')
+
+    application.bot_data['db_writer'] = asyncio.create_task(db_writer())
+
+async def post_shutdown(application: Application) -> None:
+    # Flush queued writes before the event loop goes away
+    await _write_queue.join()
+    application.bot_data['db_writer'].cancel()
+
+async def register_user(user_id, user_name):
+    await users_collection.update_one(
+        {'user_id': user_id},
+        {'$set': {'username': user_name}, '$setOnInsert': {'first_seen': datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    # Only remember the user once the write has landed, so a failed one is retried
+    _seen_users[user_id] = user_name
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name
-    
-    # Register or update user in the database
-    users_collection.update_one({'user_id': user_id}, {'$set': {'username': user_name}}, upsert=True)
 
-    update.message.reply_text(f'Hello {user_name}! Welcome to the bot.')
+    # Register or update user in the database, unless nothing has changed
+    if _seen_users.get(user_id) != user_name:
+        await queue_write(partial(register_user, user_id, user_name))
 
-def check_subscription(user_id):
-    for channel in FORCE_CHANNELS:
-        member = context.bot.get_chat_member(channel, user_id)
-        if member.status not in ['member', 'administrator']:
+    await update.message.reply_text(f'Hello {user_name}! Welcome to the bot.')
+
+async def is_member(bot, channel, user_id):
+    key = (user_id, channel)
+    if _membership_cache.get(key):
+        return True
+
+    try:
+        member = await bot.get_chat_member(channel, user_id)
+    except TelegramError as error:
+        if isinstance(error, BadRequest) and any(reason in str(error).lower() for reason in NOT_MEMBER_ERRORS):
             return False
-    return True
+        # Usually the bot isn't an admin in the channel, or the call timed out. Don't lock
+        # users out over it, and cache the verdict so the failing call isn't repeated
+        logger.warning("Could not check membership of %s in %s: %s", user_id, channel, error)
+        _membership_cache[key] = True
+        return True
+
+    # Only positive verdicts are cached so a user who just joined isn't kept out
+    # Restricted users keep that status even after leaving, so check is_member too
+    subscribed = member.status not in NOT_MEMBER_STATUSES and getattr(member, 'is_member', True)
+    if subscribed:
+        _membership_cache[key] = True
+    return subscribed
 
-def upload_file(update: Update, context: CallbackContext) -> None:
+async def check_subscription(bot, user_id):
+    # Query every channel at once instead of one round trip per channel
+    tasks = [asyncio.create_task(is_member(bot, channel, user_id)) for channel in FORCE_CHANNELS]
+    try:
+        # Give up as soon as any channel reports the user missing
+        for result in asyncio.as_completed(tasks):
+            if not await result:
+                return False
+        return True
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id not in ADMIN_IDS:
-        update.message.reply_text("You do not have permission to upload files.")
+        await update.message.reply_text("You do not have permission to upload files.")
         return
-    
+
     if update.message.document:
         document = update.message.document
         file_id = document.file_id
         file_name = document.file_name
 
         # Send the file to the dump channel
-        context.bot.send_document(chat_id=DUMP_CHANNEL, document=document)
+        await context.bot.send_document(chat_id=DUMP_CHANNEL, document=document)
 
         # Store file info in the database
-        files_collection.insert_one({
+        await queue_write(partial(files_collection.insert_one, {
             'file_id': file_id,
             'file_name': file_name,
             'uploaded_by': update.effective_user.id
-        })
+        }))
 
         # Generate a permanent link here (you may need to implement this)
         link = f"https://your-heroku-app.herokuapp.com/file/{file_id}"  # Example link generation
 
-        update.message.reply_text(f"File uploaded successfully! Here's the link: {link}")
+        await update.message.reply_text(f"File uploaded successfully! Here's the link: {link}")
 
-def broadcast_message(update: Update, context: CallbackContext) -> None:
+async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id not in ADMIN_IDS:
-        update.message.reply_text("You do not have permission to broadcast messages.")
+        await update.message.reply_text("You do not have permission to broadcast messages.")
         return
 
-    message = " ".join(context.args)
-    users = users_collection.find()
-    for user in users:
-        context.bot.send_message(chat_id=user['user_id'], text=message)
+    # Prepare the outgoing call once; media replies are copied, not re-uploaded
+    source = update.message.reply_to_message
+    if source:
+        deliver = partial(context.bot.copy_message, from_chat_id=source.chat_id, message_id=source.message_id)
+    elif context.args:
+        deliver = partial(context.bot.send_message, text=" ".join(context.args))
+    else:
+        await update.message.reply_text("Usage: /broadcast <message>, or reply to a message with /broadcast.")
+        return
+
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    interval = 1 / BROADCAST_RATE
+    next_send = time.monotonic()
+    blocked = []
+    sent = failed = 0
+
+    async def send(user_id):
+        nonlocal next_send, sent, failed
+        async with sem:
+            for attempt in range(BROADCAST_RETRIES + 1):
+                # Hand out evenly spaced send slots to stay under the per-bot limit
+                now = time.monotonic()
+                slot = max(now, next_send)
+                next_send = slot + interval
+                await asyncio.sleep(slot - now)
+
+                try:
+                    await deliver(chat_id=user_id)
+                    sent += 1
+                    return
+                except Forbidden:
+                    # The user blocked the bot, drop them after the broadcast
+                    blocked.append(user_id)
+                    return
+                except RetryAfter as error:
+                    if attempt == BROADCAST_RETRIES:
+                        logger.warning("Broadcast to %s still rate limited, giving up", user_id)
+                        failed += 1
+                        return
+                    await asyncio.sleep(retry_after_seconds(error))
+                except Exception:
+                    logger.exception("Broadcast to %s failed", user_id)
+                    failed += 1
+                    return
+
+    # Only user_id is needed; fetch it in large batches per round trip
+    cursor = users_collection.find({}, projection={'user_id': 1, '_id': 0}).batch_size(1000)
+    tasks = []
+    async for user in cursor:
+        tasks.append(asyncio.create_task(send(user['user_id'])))
+        # Drain periodically so large user bases never hold every task at once
+        if len(tasks) >= BROADCAST_CHUNK:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            tasks.clear()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    if blocked:
+        await users_collection.delete_many({'user_id': {'$in': blocked}})
 
-def view_stats(update: Update, context: CallbackContext) -> None:
-    total_users = users_collection.count_documents({})
-    total_files = files_collection.count_documents({})
-    
-    update.message.reply_text(f"Total Users: {total_users}\nTotal Files Uploaded: {total_files}")
+    await update.message.reply_text(
+        f"Broadcast finished: {sent} sent, {failed} failed, {len(blocked)} blocked the bot."
+    )
+
+async def get_stats():
+    bucket = time.monotonic() // STATS_CACHE_SECONDS if STATS_CACHE_SECONDS > 0 else None
+    if bucket is None or bucket not in _stats_cache:
+        # Unfiltered counts come from collection metadata, so run them together
+        counts = await asyncio.gather(
+            users_collection.estimated_document_count(),
+            files_collection.estimated_document_count()
+        )
+        _stats_cache.clear()
+        _stats_cache[bucket] = counts
+    return _stats_cache[bucket]
+
+async def view_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    total_users, total_files = await get_stats()
+
+    await update.message.reply_text(f"Total Users: {total_users}\nTotal Files Uploaded: {total_files}")
+
+application = (
+    Application.builder()
+    .token("YOUR_TOKEN")  # Replace with your bot token
+    .concurrent_updates(MAX_CONCURRENCY)
+    # Wait longer for a free pooled connection during bursts, and for slow uploads
+    .pool_timeout(5)
+    .connect_timeout(5)
+    .read_timeout(30)
+    .post_init(post_init)
+    .post_shutdown(post_shutdown)
+    .build()
+)
+
+# Every handler below is message based
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+# Register handlers
+application.add_handler(CommandHandler('start', start))
+application.add_handler(MessageHandler(filters.Document.ALL, upload_file))
+application.add_handler(CommandHandler('broadcast', broadcast_message))
+application.add_handler(CommandHandler('stats', view_stats))  # Command to show stats
+
+async def set_webhook():
+    delay = 1.0
+    for attempt in range(WEBHOOK_ATTEMPTS):
+        try:
+            await application.bot.set_webhook(
+                url=f"https://{RAILWAY_STATIC_URL}/webhook",
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=True,
+                secret_token=WEBHOOK_SECRET
+            )
+            return
+        except BadRequest:
+            # A rejected URL or token won't fix itself by retrying
+            raise
+        except (RetryAfter, NetworkError) as error:
+            if attempt == WEBHOOK_ATTEMPTS - 1:
+                raise
+            wait = delay
+            if isinstance(error, RetryAfter):
+                # Retrying inside the flood-wait window only burns attempts
+                wait = max(delay, retry_after_seconds(error))
+            # Jitter keeps repeated boots from retrying in lockstep
+            wait += random.random()
+            logger.warning("Setting the webhook failed, retrying in %.1f s", wait)
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, 30)
+
+async def register_webhook():
+    async with application.bot:
+        await set_webhook()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Admin checks trust the posted update, so never accept unauthenticated ones
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set to serve the webhook")
+
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    yield
+    await application.stop()
+    await application.shutdown()
+    await post_shutdown(application)
+
+web_app = FastAPI(lifespan=lifespan)
+
+# Pre-encoded reply shared by the webhook and health check
+_OK = Response(content=b'{"status":"ok"}', media_type='application/json')
+
+@web_app.post('/webhook')
+async def process_webhook(request: Request):
+    # Reject from the headers alone, before reading or parsing the body
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not secrets.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return Response(status_code=403)
+    content_length = request.headers.get('Content-Length')
+    if content_length is not None:
+        if not content_length.isdigit():
+            return Response(status_code=400)
+        if int(content_length) > MAX_UPDATE_BYTES:
+            return Response(status_code=413)
+
+    # Chunked bodies carry no length, so enforce the cap while reading too
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > MAX_UPDATE_BYTES:
+            return Response(status_code=413)
+
+    try:
+        data = orjson.loads(body)
+        if not isinstance(data, dict):
+            raise ValueError("update is not a JSON object")
+        update = Update.de_json(data, application.bot)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return Response(status_code=400)
+
+    # The update queue is unbounded, so this never has to wait
+    application.update_queue.put_nowait(update)
+    return _OK
+
+@web_app.get('/health')
+async def health_check():
+    return _OK
 
 def main():
-    updater = Updater("YOUR_TOKEN")  # Replace with your bot token
-    dp = updater.dispatcher
-
-    # Register handlers
-    dp.add_handler(CommandHandler('start', start))
-    dp.add_handler(MessageHandler(Filters.document, upload_file))
-    dp.add_handler(CommandHandler('broadcast', broadcast_message))
-    dp.add_handler(CommandHandler('stats', view_stats))  # Command to show stats
-
-    # Start polling for updates
-    updater.start_polling()
-    updater.idle()
+    global WEBHOOK_SECRET
+
+    if RAILWAY_STATIC_URL:
+        if not WEBHOOK_SECRET:
+            # Workers import this module afresh and read the secret from the environment
+            WEBHOOK_SECRET = os.environ['WEBHOOK_SECRET'] = secrets.token_urlsafe(32)
+
+        # Register once here, not in every worker, so pending updates are dropped
+        # only at boot and setWebhook isn't called once per worker
+        asyncio.run(register_webhook())
+
+        # Telegram pushes updates to the webhook, no polling needed
+        uvicorn.run(
+            'bot:web_app',
+            host='0.0.0.0',
+            port=PORT,
+            workers=WEB_CONCURRENCY,
+            loop='uvloop',
+            http='httptools'
+        )
+    else:
+        uvloop.install()
+
+        # Long-poll so each getUpdates call waits for updates instead of spinning
+        application.run_polling(
+            poll_interval=0,
+            timeout=50,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=True
+        )
 
 if __name__ == '__main__':
     main()